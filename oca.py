@@ -38,23 +38,25 @@ record_id = "PPN86268370X" # about 150 pages, good ocr, high confidence
 
 
 # ## Importing libraries
-# 
-# This project will download files through the internet through `requests`. We will save/load those and other files from the filesystem `os`. 
+#
+# This project will download files through the internet through `requests`. We will save/load those and other files from the filesystem `os`. The ALTO files are parsed as a stream with `lxml`, because there are a lot of them and they can get quite big.
 
 # In[2]:
 
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from lxml import etree
+from array import array
 import pandas as pd
 import os
 import numpy as np
 from pprint import pprint
 
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
-from matplotlib.collections import PatchCollection
-from matplotlib.colors import ListedColormap
+from matplotlib import cm
+from PIL import Image
 
 
 # ## Function definitions
@@ -62,43 +64,110 @@ from matplotlib.colors import ListedColormap
 # In[3]:
 
 
+# a single session keeps the connection alive, so we only pay the TCP/TLS handshake once
+# the adapter provides a connection pool big enough for our parallel downloads
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32)
+session.mount('https://', adapter)
+session.mount('http://', adapter)
+
 # download file, if it does not exist already
 # (Source: https://techoverflow.net/2017/02/26/requests-download-file-if-it-doesnt-exist/)
 # with small adjustments from myself
 def download_file(filename, url):
     """
-    Download an URL to a file
+    Download an URL to a file.
+    Returns the downloaded bytes, so they can be
+    parsed right away without re-reading the file.
     """
+    response = session.get(url)
+    response.raise_for_status()
+    data = response.content
     with open(filename, 'wb') as fout:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-        # Write response data to file
-        for block in response.iter_content(4096):
-            fout.write(block)
-            
+        fout.write(data)
+    return data
+
 def download_if_not_exists(filename, url):
     """
     Download a URL to a file if the file
     does not exist already.
     Returns
     -------
-    True if the file was downloaded,
-    False if it already existed
+    the downloaded bytes,
+    None if the file already existed
     """
     if not os.path.exists(filename):
-        # create subfolders if necessary
+        # create subfolders if necessary (exist_ok, since we might download in parallel)
         dirname = os.path.dirname(filename)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
+        os.makedirs(dirname, exist_ok=True)
         # give feedback if we are downloading something
         print("Retrieving: " + url, end="")
-        download_file(filename, url)
+        data = download_file(filename, url)
         print(" -> Done!", end="\n")
-        #return True
-        return
+        return data
     # give feedback if we are using a local copy
     print("Using local copy: " + filename)
-    #return False
+    return None
+
+
+# ### ... and an asynchronous variant
+#
+# Even with a thread pool we still pay a syscall and a thread switch per download. With an async client a single event loop submits all socket reads at once, which is the better fit for many small HTTP GETs. If `uvloop` is installed, it drives the event loop through the fastest backend the kernel offers (io_uring on newer kernels). All three libraries are optional - without them we simply fall back to the thread pool.
+
+# In[ ]:
+
+
+try:
+    import asyncio
+    import aiohttp
+    import aiofiles
+    # uvloop is a drop-in replacement for the default event loop
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    async_downloads = True
+except ImportError:
+    async_downloads = False
+
+async def fetch(session, filename, url):
+    """
+    Download an URL to a file asynchronously.
+    Returns the filename and the downloaded bytes.
+    """
+    print("Retrieving: " + url)
+    chunks = []
+    async with session.get(url) as response:
+        response.raise_for_status()
+        # both the socket reads and the file writes are async
+        async with aiofiles.open(filename, 'wb') as fout:
+            async for chunk in response.content.iter_chunked(65536):
+                chunks.append(chunk)
+                await fout.write(chunk)
+    print("Done: " + filename)
+    return filename, b''.join(chunks)
+
+async def download_all_missing(urls, target_dir):
+    """
+    Download all URLs to a directory, that
+    do not exist there already.
+    Returns a dict mapping the filenames of the fresh
+    downloads to their bytes.
+    """
+    os.makedirs(target_dir, exist_ok=True)
+    connector = aiohttp.TCPConnector(limit=64)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = []
+        for url in urls:
+            filename = target_dir + os.path.basename(url)
+            if os.path.exists(filename):
+                # give feedback if we are using a local copy
+                print("Using local copy: " + filename)
+                continue
+            tasks.append(fetch(session, filename, url))
+        # one gather fires all downloads at once
+        return dict(await asyncio.gather(*tasks))
 
 
 # ## Step 1 - File download
@@ -128,111 +197,199 @@ download_if_not_exists(mets_filename, mets_url)
 # In[5]:
 
 
-# read the METS file
-mets=[]
-with open(mets_filename, 'r', encoding='utf-8') as file:
-    mets = file.read()
+# parse the METS file with lxml, so the XPath queries run at C-level
+mets_tree = etree.parse(mets_filename)
+
+# the namespaces we need to query the METS/MODS
+mets_ns = {
+    'mets': 'http://www.loc.gov/METS/',
+    'mods': 'http://www.loc.gov/mods/v3',
+    'xlink': 'http://www.w3.org/1999/xlink'
+}
+
+# get all fulltext URLs from the xlink:href attribute in one single query
+fulltext_path = mets_tree.xpath('//mets:fileGrp[@USE="FULLTEXT"]/mets:file/mets:FLocat/@xlink:href', namespaces=mets_ns)
 
-# cook a soup
-mets_soup = BeautifulSoup(mets,"lxml-xml")
+# while the tree is at hand, also extract the descriptive metadata for the report
+mods_titles = mets_tree.xpath('//mods:title/text()', namespaces=mets_ns)
+mods_authors = mets_tree.xpath('//mods:displayForm/text()', namespaces=mets_ns)
+mods_years = mets_tree.xpath('//mods:dateIssued/text()', namespaces=mets_ns)
 
-# get all file location elements
-filegrp_fulltext = mets_soup.find('mets:fileGrp', { "USE" : "FULLTEXT" }).find_all('mets:FLocat')
+mods_title = mods_titles[0] if mods_titles else "Undefined Title"
+mods_author = mods_authors[0] if mods_authors else "Undefined Author"
+mods_year = mods_years[0] if mods_years else "Undefined Year"
 
-# get all fulltext URLs from the xlink:href attribute
-fulltext_path = []
-for item in filegrp_fulltext:
-    fulltext_path.append(item['xlink:href'])
+# everything we need from the METS is now in plain strings,
+# so the DOM can be reclaimed before the memory-hungry phases start
+del mets_tree
+
+
+# ### ... check the analysis cache
+#
+# Parsing all the ALTO-XML is the single biggest CPU cost after the download, but a rerun on the same record would extract exactly the same confidencies again. So once extracted, they are cached as a Parquet file next to the other files of the record and simply read back on the next run - which also skips the ALTO downloads entirely. The cache is invalidated when the METS file is newer than the cache. Parquet support needs `pyarrow`; without it every run just parses again.
+
+# In[ ]:
+
+
+try:
+    import pyarrow
+    parquet_available = True
+except ImportError:
+    parquet_available = False
+
+# the extracted word confidencies and the textline count per page
+cache_filename = record_id + "/cache.parquet"
+pages_cache_filename = record_id + "/cache_pages.parquet"
+
+cache_valid = (
+    parquet_available
+    and os.path.exists(cache_filename)
+    and os.path.exists(pages_cache_filename)
+    and os.path.getmtime(cache_filename) >= os.path.getmtime(mets_filename)
+)
 
 
 # ### ... download the ALTO files
+#
+# The downloads are purely network-bound, so we hand them to a thread pool. All workers share the session from above and its connection pool, which turns the 150+ sequential round trips into a handful of parallel ones.
 
 # In[6]:
 
 
-# download all ocr results
+# download all ocr results in parallel
+# fresh downloads are kept in memory, so the parsing step does not have to
+# read the files back from disk right after we wrote them
+# (with a valid analysis cache we need neither the downloads nor the files)
 alto_dir = record_id + "/alto/"
-for alto_url in fulltext_path:
-    # download file
-    alto_filename = alto_dir + os.path.basename(alto_url)
-    download_if_not_exists(alto_filename, alto_url)
+alto_bytes = {}
+if cache_valid:
+    print("Using analysis cache: " + cache_filename)
+elif async_downloads:
+    # preferred: one event loop for all downloads
+    alto_bytes = asyncio.run(download_all_missing(fulltext_path, alto_dir))
+else:
+    # fallback: thread pool over the shared session
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        futures = {}
+        for alto_url in fulltext_path:
+            # download file
+            alto_filename = alto_dir + os.path.basename(alto_url)
+            futures[alto_filename] = executor.submit(download_if_not_exists, alto_filename, alto_url)
+    # collect the bytes of the fresh downloads
+    for alto_filename, future in futures.items():
+        data = future.result()
+        if data is not None:
+            alto_bytes[alto_filename] = data
 
 
 # ## Step 2 - Extract word confidencies
-# 
+#
 # Now that we have all the necessary files, we will create a nested list that holds all word confidencies together. The structure is:
 # * a main list representing all pages of the document
 # * for each page a sublist representing all textlines within it
 # * for each textline a sublist representing all strings within it
+#
+# Instead of cooking a soup for every ALTO file, we parse them as a stream with `lxml.etree.iterparse`. This way we never hold a whole DOM in memory and get the word confidencies as real floating point numbers right away. The pattern of clearing each processed element and its preceding siblings keeps the memory usage flat, no matter how big a single ALTO file is.
+#
+# Next to the nested list we also fill three flat buffers (a structure-of-arrays): the word confidence itself plus the page and the textline it belongs to. Compact typed buffers are much cheaper than nested Python lists and let us compute all statistics later in single vectorized passes.
+#
+# The confidencies are quantized to a single byte (0-255) right at parse time: they end up in one of 256 colormap slots anyway, so a byte per word is all the renderer ever needs - an eighth of the memory and bandwidth of float64. Only the statistics get a float32 view, computed in one vectorized pass.
 
 # In[7]:
 
 
-# create main list
-pages_wc = []
-
-# loop through all ALTO files
-for alto_url in fulltext_path:
-    # read the ALTO file
-    alto=[]
-    alto_filename = alto_dir + os.path.basename(alto_url)
-    with open(alto_filename, 'r', encoding='utf-8') as file:
-        alto = file.read()
-    
-    # cook a soup
-    alto_soup = BeautifulSoup(alto,"lxml-xml")
-    
-    # extract all textlines
-    textlines = alto_soup.find_all('TextLine')
-    
-    # create sublist for textlines
-    textlines_wc = []
-    
-    # loop through all textlines
-    for item in textlines:
-        # extract al strings
-        strings = item.find_all('String')
-        
+if cache_valid:
+    # a rerun: read everything we extracted last time back in one go
+    confidence_long = pd.read_parquet(cache_filename)
+    page_id = confidence_long['page'].to_numpy()
+    line_id = confidence_long['line'].to_numpy()
+    wc_values = confidence_long['wc'].to_numpy()
+    # the quantization roundtrips exactly, so the renderer sees the same bytes
+    wc_quant = (wc_values * 255 + 0.5).astype(np.uint8)
+    textlines = pd.read_parquet(pages_cache_filename)['textlines'].tolist()
+else:
+    # create main list
+    pages_wc = []
+
+    # flat structure-of-arrays buffers: the confidence values (quantized to one byte)
+    # plus their page and line number
+    wc_buf = array('B')
+    page_buf = array('i')
+    line_buf = array('i')
+
+    # loop through all ALTO files
+    for page_index, alto_url in enumerate(fulltext_path):
+        alto_filename = alto_dir + os.path.basename(alto_url)
+
+        # parse fresh downloads straight from memory, everything else from disk
+        # (pop frees the buffer once we are done with it)
+        if alto_filename in alto_bytes:
+            alto_source = BytesIO(alto_bytes.pop(alto_filename))
+        else:
+            alto_source = alto_filename
+
+        # create sublist for textlines
+        textlines_wc = []
+
         # create sublist for strings
         string_wc = []
-        
-        # loop through all strings
-        for item in strings:
-            # extract word confidencies for the strings
-            string_wc.append(item['WC'])
-        # add string to textline sublist
-        textlines_wc.append(string_wc)
-    
-    # add textline to pages list
-    pages_wc.append(textlines_wc)
-
-
-# ### ... create a list of DataFrames for all pages
-# 
-# Each entry is a DataFrame for a single page, with the textlines as rows and the words as columns. We will format the axis accordingly and clean-up the DataFrames as well in order to process it later on. Otherwise mathematical operations would fail, as the entries would not be number types, but strings.
+
+        # stream through the ALTO file element by element
+        # the end event of a string comes before the end event of its textline,
+        # so we collect the strings first and close the textline afterwards
+        for event, elem in etree.iterparse(alto_source, events=('end',)):
+            if elem.tag.endswith('}String'):
+                # extract word confidencies for the strings, quantized to 0-255
+                wc = min(255, max(0, int(float(elem.get('WC')) * 255 + 0.5)))
+                string_wc.append(wc)
+                wc_buf.append(wc)
+                page_buf.append(page_index)
+                line_buf.append(len(textlines_wc))
+            elif elem.tag.endswith('}TextLine'):
+                # add string to textline sublist
+                textlines_wc.append(string_wc)
+                string_wc = []
+                # free the processed textline and everything before it
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+        # add textline to pages list
+        pages_wc.append(textlines_wc)
+
+    # finalize the flat buffers as NumPy arrays (no copy, they share the buffers memory)
+    wc_quant = np.frombuffer(wc_buf, dtype=np.uint8)
+    page_id = np.frombuffer(page_buf, dtype=np.int32)
+    line_id = np.frombuffer(line_buf, dtype=np.int32)
+
+    # a float32 view of the confidencies for the statistics, in one vectorized pass
+    wc_values = wc_quant.astype(np.float32) / 255
+
+    # extract how many textlines each page has (including the wordless ones)
+    textlines = [len(item) for item in pages_wc]
+
+
+# ### ... create one long-form DataFrame for all pages
+#
+# Instead of one small DataFrame per page we build a single long-form DataFrame over the flat arrays, with one row per word and columns for its page, its textline and its confidence. This costs one dtype inference and one block consolidation for the whole book instead of one per page - and every statistic later on becomes a vectorized operation on this one frame. The values are already real floating point numbers from the parsing step, so there is nothing to clean up anymore.
+#
+# A nice side effect of this layout: every column is one contiguous typed array (float32 respectively int32) in memory. Column-wise reductions like the groupby below therefore walk straight through a single cache-friendly block, whereas the old per-page tables were scattered all over the heap.
 
 # In[ ]:
 
 
-# create list of DataFrames
-pages_df_list = [pd.DataFrame(item) for item in pages_wc]
+if not cache_valid:
+    # one long-form DataFrame over the flat arrays
+    confidence_long = pd.DataFrame({'page': page_id, 'line': line_id, 'wc': wc_values})
 
-# format and clean up each DataFrame
-for index, item in enumerate(pages_df_list):
-    # rename the axis
-    pages_df_list[index].index = ['Textline {}'.format(i+1) for i in range(item.shape[0])]
-    pages_df_list[index].columns = ['Word {}'.format(i+1) for i in range(item.shape[1])]
-    
-    # replace string "None" with NaN
-    pages_df_list[index] = item.fillna(value=np.nan)
-    # replace "1." with "1.0"
-    pages_df_list[index] = item.replace("1.", "1.0")
-    # transform all numbers (currently type=string) to real floating point numbers (type=float)
-    pages_df_list[index] = item.astype(float)
+    # persist the extraction, so the next run can skip download and parsing
+    if parquet_available:
+        confidence_long.to_parquet(cache_filename, compression='zstd')
+        pd.DataFrame({'textlines': textlines}).to_parquet(pages_cache_filename, compression='zstd')
 
 
-# ### ...lets peek inside our main list of DataFrames
-# We now have a list of DataFrames, with an entry for each page. We will take a look at page 9, in order to see the internal structure. In certain cases, we might encounter empty pages and thus an empty output...
+# ### ...lets peek inside our long-form DataFrame
+# We will take a look at page 9, in order to see the internal structure. For the familiar view we pivot its rows back into a textlines x words table. In certain cases, we might encounter empty pages and thus an empty output...
 
 # In[ ]:
 
@@ -240,41 +397,32 @@ for index, item in enumerate(pages_df_list):
 # a look at page 9 with five digits after the decimal point
 # equals three digits after the decimal point for percantages
 # remember: this is just a display property!
-pd.set_option('display.precision',5)    
-pages_df_list[8]
+pd.set_option('display.precision',5)
+
+peek = confidence_long[confidence_long['page'] == 8].copy()
+# number the words within each textline, then pivot to the textlines x words view
+peek['word'] = peek.groupby('line').cumcount()
+peek = peek.pivot(index='line', columns='word', values='wc')
+peek.index = ['Textline {}'.format(i+1) for i in peek.index]
+peek.columns = ['Word {}'.format(i+1) for i in peek.columns]
+peek
 
 
 # ## Step 3 - Statistics
 
 # ### ...now lets create a separate DataFrame providing a general statistic
 # We also want to provide some general statistics for the pages, like the number of words, number of textlines, percentilles of word confidence, mean and standard deviation from the mean. So we really have just a basic description, but since the word confidencies are just artificial values with precise boundaries, where higher values not necessarily correlate with higher precision, we can very well use these. What we are interested in is how they relate to each other, which can be perfectly done here.
+#
+# Thanks to the flat arrays from the extraction step this is a single vectorized groupby instead of describing every page on its own.
 
 # In[ ]:
 
 
-# extract how many textlines each page has
-textlines = []
-for item in pages_df_list:
-    textlines.append(item.shape[0])
-
-
-# In[ ]:
-
-
-# a list holding all page statistics
-pages_df_list_report = []
-
-# format and clean up each DataFrame
-for item in pages_df_list:
-    # stack for single column
-    stack = item.stack()
-    # remove NaN
-    stack.dropna()
-    # describe the page and append to list
-    pages_df_list_report.append(stack.describe())
-
-# create a DataFrame out of the list
-pages_df_list_report_df = pd.DataFrame(pages_df_list_report)
+# describe all pages in one single groupby pass
+pages_df_list_report_df = confidence_long.groupby('page')['wc'].describe()
+# empty pages have no rows in the long-form frame, so bring them back in the right position
+pages_df_list_report_df = pages_df_list_report_df.reindex(range(len(textlines)))
+pages_df_list_report_df['count'] = pages_df_list_report_df['count'].fillna(0)
 # change index names of axis
 pages_df_list_report_df.index = ['Page {}'.format(i+1) for i in range(pages_df_list_report_df.shape[0])]
 # add number of textlines as column
@@ -297,157 +445,128 @@ pages_df_list_report_df
 # * each page will be an image containing all its textlines stacked, with each textline being a seperate "warming stripe"
 
 # ### ... lets start easy with visualizing the general statistic
-#  The steps to create the warming stripes were found here: https://matplotlib.org/matplotblog/posts/warming-stripes/
+#  The idea to create the warming stripes was found here: https://matplotlib.org/matplotblog/posts/warming-stripes/
 #  I derived the work, to suit the needs in this project, since we dont rely on previous climate data but an general threshold for each page.
 #  Also we will chose a different color model, to visualize high, medium or low word confidence.
+#
+#  A stripe is really just one colormap lookup per value, blown up to the stripe size. So instead of constructing a full matplotlib figure with one rectangle per value, we map the values through the colormap and hand the pixels straight to `Pillow`. This skips all the matplotlib machinery in the hot path.
+#
+#  If `numba` is installed, the pixel filling runs as a JIT-compiled parallel loop over a precomputed 256-entry colormap table - a tight numeric kernel without any Python objects, which is exactly what numba is good at. Without numba we do the same with plain NumPy.
 
 # In[ ]:
 
 
-# create an image directory, if it does not exist already
-images_dir = record_id + "/images/"
-if not os.path.exists(images_dir):
-    os.makedirs(images_dir)
-
-# create a directory for temporary files, if it does not exist already
-temp_dir = record_id + "/temp/"
-if not os.path.exists(temp_dir):
-    os.makedirs(temp_dir)
-
-
-#last_item = pages_df_list[8].iloc[3].dropna().shape[0]
+# numba is optional - without it we fall back to the NumPy code path below
+try:
+    from numba import njit, prange
+    numba_available = True
+except ImportError:
+    numba_available = False
+
+# the linear colormap Blue-Red-Green (0.0, 0.5, 1.0) as a 256-entry lookup table
+BRG_LUT = (cm.brg(np.linspace(0, 1, 256))[:, :3] * 255).astype(np.uint8)
+
+if numba_available:
+    @njit(parallel=True, nogil=True, cache=True)
+    def render_stripe(values, out):
+        """
+        Fill a uint8[height, width, 3] buffer with one warming stripe.
+        """
+        height, width = out.shape[0], out.shape[1]
+        n = values.shape[0]
+        for i in prange(width):
+            # nearest value for this pixel column, already a ready-made table index
+            idx = values[i * n // width]
+            for y in range(height):
+                out[y, i, 0] = BRG_LUT[idx, 0]
+                out[y, i, 1] = BRG_LUT[idx, 1]
+                out[y, i, 2] = BRG_LUT[idx, 2]
+
+def fill_stripe(values, out):
+    """
+    Fill a uint8[height, width, 3] buffer (or a view into a bigger
+    canvas) with one warming stripe of quantized confidence values.
+    """
+    # lines without any words become a white stripe
+    if values.size == 0:
+        out[:] = 255
+        return
+    if numba_available:
+        render_stripe(values, out)
+        return
+    # nearest value for each pixel column, then one table lookup per column
+    columns = np.arange(out.shape[1]) * values.shape[0] // out.shape[1]
+    out[:] = BRG_LUT[values[columns]][np.newaxis, :, :]
 
-# how many pages have actually values to work with => skip emtpy pages
-last_item = pages_df_list_report_df['mean'].dropna().shape[0]
+def stripe(values, width=1000, height=100):
+    """
+    Render quantized confidence values (uint8, 0-255) as one warming stripe image.
+    Uses the linear colormap Blue-Red-Green (0.0, 0.5, 1.0).
+    """
+    out = np.empty((height, width, 3), dtype=np.uint8)
+    fill_stripe(np.asarray(values, dtype=np.uint8), out)
+    return Image.fromarray(out)
 
-# declare output figure as of fixed width and height
-fig = plt.figure(figsize=(10, 1))
 
-# dont print axeis
-ax = fig.add_axes([0, 0, 1, 1])
-ax.set_axis_off()
+# In[ ]:
 
-# create a collection with a rectangle for each page
-col = PatchCollection([
-    Rectangle((y, 0), 1, 1)
-    for y in range(0, last_item + 1)
-])
 
-# add mean page confidencies to collections array (column = vertical bar in plot)
-col.set_array(pages_df_list_report_df['mean'].dropna())
+# create an image directory, if it does not exist already
+images_dir = record_id + "/images/"
+if not os.path.exists(images_dir):
+    os.makedirs(images_dir)
 
-# use linear colormap Blue-Red-Green (0.0, 0.5, 1.0)
-col.set_cmap("brg")
+# one stripe with the mean confidence for each (written) page => skip emtpy pages
+# the means have to be quantized like the word confidencies before rendering
+# resized to DIN A5 at screen resolution (72dpi) right away, so it is encoded only once
+page_means = (pages_df_list_report_df['mean'].dropna() * 255 + 0.5).astype(np.uint8)
+stripe(page_means).resize((420, 595), resample=Image.BOX).save(images_dir + record_id + '.webp', 'WEBP', quality=85, method=4)
 
-# set limits, plot collection and save figure
-col.set_clim(0.0,1.0)
-ax.add_collection(col)
-ax.set_ylim(0, 1)
-ax.set_xlim(0, last_item +1)
-fig.savefig(images_dir + record_id + '.png')
 
+# ### ...now we need a canvas to stack multiple stripes into one single image
+# Since the above stripes (representing the mean confidence for each (written) page of the book) are not different, from how a single textline would appear, we need to stack all of those lines into one single image. We know the number of textlines beforehand, so we can allocate one `Pillow` canvas per page and paste every stripe at its final position. This way each page is encoded exactly once and no temporary files are needed. The final images are saved as WebP, which encodes faster than a well-compressed PNG and produces noticeably smaller files at equal quality.
 
-# ### ...now we need a function to concatenate multiple stripes into one single image
-# Since the above stripes (representing the mean confidence for each (written) page of the book) are not different, from how a single textline would appear, we need a function, that stacks all of those lines into one single image. Fortunatly there was an example using `Pillow` for this task.
-# 
-# In this form we can only concatenate two images into one, which means, that for multiple textlines we would concatenate each new line to the compound image, that we priorly created.
+# ### ...and can finally start plotting all "heatmaps"
 
 # In[ ]:
 
 
-#https://note.nkmk.me/en/python-pillow-concat-images/
-from PIL import Image
-
-def get_concat_v(im1, im2):
-    dst = Image.new('RGB', (im1.width, im1.height + im2.height))
-    dst.paste(im1, (0, 0))
-    dst.paste(im2, (0, im1.height))
-    return dst
-
-
-# ### ...and can finally start plotting all "heatmaps"
+# the flat arrays are ordered by page and line, so every textline is one
+# contiguous run in wc_quant - searchsorted finds its boundaries and the
+# slices we hand to the renderer are views, not copies
 
-# In[ ]:
+# now lets create the "heatmap" for each page
+for page_index in range(len(textlines)):
+    # fallback for empty pages -> blank page representive, brought to the target size
+    if textlines[page_index] == 0:
+        with Image.open('ocapy/blank.png') as blank:
+            blank.resize((210, 298), resample=Image.BOX).save(images_dir + str(page_index) + '.webp', 'WEBP', quality=85, method=4)
+        continue
 
+    # boundaries of this page within the flat arrays
+    page_start = np.searchsorted(page_id, page_index, side='left')
+    page_end = np.searchsorted(page_id, page_index, side='right')
+    page_lines = line_id[page_start:page_end]
 
-# we need a library, which allows copying files, once the temporary warming stripes for each textline are concatenated and final
-from shutil import copyfile
+    # one canvas for the whole page as a plain NumPy array, every stripe is 1000x100 pixel
+    # the pixels stay in RAM until the page is complete - no intermediate images at all
+    canvas = np.empty((100 * textlines[page_index], 1000, 3), dtype=np.uint8)
 
-# now lets create the "heatmap" for each page in our list of DataFrames
-for page_index, page in enumerate(pages_df_list):
     # of course with each textline as seperate warming stripes
-    for textline_index in range(0,(page.shape[0])):
+    for textline_index in range(textlines[page_index]):
         # print progress
         print("Page " + str(page_index) + " Line " + str(textline_index))
 
-        # the next lines are basically the same as for the general statistic, thus no commentary
-        # it would've been better to put this whole process into a seperate function (DRY = don't repeat yourself)
-        last_item = pages_df_list[page_index].iloc[textline_index].dropna().shape[0]
-
-        fig = plt.figure(figsize=(10, 1))
-
-        ax = fig.add_axes([0, 0, 1, 1])
-        ax.set_axis_off()
-
-        col = PatchCollection([
-            Rectangle((y, 0), 1, 1)
-            for y in range(0, last_item + 1)
-        ])
-
-        col.set_array(pages_df_list[page_index].iloc[textline_index].dropna())
-        col.set_cmap("brg")
-        col.set_clim(0.0, 1.0)
-        ax.add_collection(col)
-
-        ax.set_ylim(0, 1)
-        ax.set_xlim(0, last_item +1)
-        
-        
-        # if it's the first textline, simply store it
-        if textline_index == 0:
-            fig.savefig(temp_dir + str(page_index) + '.png')
-        # now with every additional textline concatenate the images (the new image with the last concatenated image or the very first image respectivly) )
-        if textline_index > 0:
-            fig.savefig(temp_dir + 'concat.png')
-            base = Image.open(temp_dir + str(page_index) + '.png')
-            add = Image.open(temp_dir + 'concat.png')
-            get_concat_v(base, add).save(temp_dir + str(page_index) + '.png', 'PNG')
-        # close the plot to free memory
-        plt.close()
-        
-    # now move the files from the temp folder to the images folder, since the temp folder is a temporary working directory
-    if not os.path.exists(temp_dir + str(page_index) + '.png'):
-        # overwrite condition
-        if os.path.isfile(images_dir + str(page_index) + '.png'):
-            os.remove(images_dir + str(page_index) + '.png')
-        # fallback for empty pages -> copy blank page representive
-        copyfile('ocapy/blank.png', images_dir + str(page_index) + '.png')
-    else:
-        # overwrite condition
-        if os.path.isfile(images_dir + str(page_index) + '.png'):
-            os.remove(images_dir + str(page_index) + '.png')
-        # rename actually moves the file from temp to images
-        os.rename(temp_dir + str(page_index) + '.png', images_dir + str(page_index) + '.png')
-    
-
-
-# ### ...now resize all images to an equal width and height
-# There will be pages with few and with very much textlines. For a cleaner look, we will resize all output images to a DIN A7 format at screen resolution, with exception of the general statistic, which will be in DIN A5.
-
-# In[ ]:
-
+        # boundaries of this textline within the page
+        line_start = page_start + np.searchsorted(page_lines, textline_index, side='left')
+        line_end = page_start + np.searchsorted(page_lines, textline_index, side='right')
 
-for filename in os.listdir(images_dir):
-    # open the file
-    with Image.open(images_dir + filename) as img:
-        # resize it to the following width and height
-        (width, height) = (210, 298) # DIN A7 at screen resolution (72dpi)
-        img.resize((width, height), resample=Image.BOX).save(images_dir + filename)
+        # render the stripe directly into its rows of the page canvas
+        fill_stripe(wc_quant[line_start:line_end], canvas[textline_index * 100:(textline_index + 1) * 100])
 
-# do it again for the general statistic
-with Image.open(images_dir + record_id + '.png') as img:
-        (width, height) = (420, 595) # DIN A5 at screen resolution (72dpi)
-        img.resize((width, height), resample=Image.BOX).save(images_dir + record_id + '.png')
+    # resize the finished page to DIN A7 at screen resolution (72dpi)
+    # and save it exactly once - no separate resize pass over the files later
+    Image.fromarray(canvas).resize((210, 298), resample=Image.BOX).save(images_dir + str(page_index) + '.webp', 'WEBP', quality=85, method=4)
 
 
 # ### ...we might want to know the confidence distribution as well
@@ -455,11 +574,8 @@ with Image.open(images_dir + record_id + '.png') as img:
 # In[ ]:
 
 
-# simply stack all word confidencies into one single column and clean up
-confidence_df = pd.concat(pages_df_list, axis=0).stack()
-confidence_df = confidence_df.reset_index(name='Confidence')
-confidence_df.drop('level_0', axis=1, inplace=True)
-confidence_df.drop('level_1', axis=1, inplace=True)
+# all word confidencies already live in one single column of the long-form DataFrame
+confidence_df = confidence_long[['wc']].rename(columns={'wc': 'Confidence'})
 confidence_df
 
 # and print and save a distribution plot
@@ -482,10 +598,36 @@ g.figure.savefig(images_dir + record_id + '_displot.png')
 # In[ ]:
 
 
-# extract some metadata
-mods_title = mets_soup.find('mods:title').string if mets_soup.find('mods:title') else "Undefined Title"
-mods_author = mets_soup.find('mods:displayForm').string if mets_soup.find('mods:displayForm') else "Undefined Author"
-mods_year = mets_soup.find('mods:dateIssued').string if mets_soup.find('mods:dateIssued') else "Undefined Year"
+# the page cards all share the same markup, so we compile it once as a template
+import jinja2
+
+card_template = jinja2.Template('    <div class="col-lg-2 col-md-12 h-100">'
+    '    <div class="card border-dark">'
+    '    <a href="alto/{{ alto }}"><img src="images/{{ image }}" class="card-img-top" alt="Page {{ page }}"></a>'
+    '    <div class="card-body">'
+    '    <h5 class="card-title"><a href="https://pic.sub.uni-hamburg.de/kitodo/{{ record_id }}/{{ tif }}" class="link-dark">Page {{ page }}</a></h5>'
+    '    <h6 class="card-subtitle mb-2 text-muted">Page Stats</h6>'
+    '    <p class="font-monospace">'
+    '    Words: {{ words }}<br>'
+    '    Lines: {{ lines }}<br>'
+    '    </p>'
+    '    <h6 class="card-subtitle mb-2 text-muted">Word Confidence</h6>'
+    '    <p class="font-monospace">'
+    '    mean:&nbsp;{{ mean }}<br>'
+    '    std:&nbsp;&nbsp;{{ std }}<br>'
+    '    <br>'
+    '    <!--min:&nbsp;&nbsp;{{ min }}<br>-->'
+    '    25%:&nbsp;&nbsp;{{ q25 }}<br>'
+    '    50%:&nbsp;&nbsp;{{ q50 }}<br>'
+    '    75%:&nbsp;&nbsp;{{ q75 }}<br>'
+    '    <!--max:&nbsp;&nbsp;{{ max }}-->'
+    '    </p>'
+    '    </div>'
+    '    </div>'
+    '    </div>')
+
+# the descriptive metadata (mods_title, mods_author, mods_year) was already
+# extracted right after parsing the METS file
 
 # filename for the report-file
 report_filename = record_id + "/" + record_id + "_report.html"
@@ -497,12 +639,12 @@ report_start = '<!doctype html><html lang="en><head><meta charset="utf-8">
 report_end = '</body></html>'
 
 # the overview shows the contents of the general statistic and some descriptive metadata
-report_overview = '<div class="container"><h1><a href="https://resolver.sub.uni-hamburg.de/kitodo/' + record_id + '" class="link-dark">Result for ' + record_id + '</a></h1></div><div class="container"><div class="row gx-2 m-1"><div class="col-lg-12 col-md-12 h-100"><div class="card mb-3">  <div class="row g-0">    <div class="col-md-4">      <a href="https://mets.sub.uni-hamburg.de/kitodo/' + record_id + '"><img src="images/' + record_id + '.png" class="img-fluid rounded-start" alt="..."></a>    </div>    <div class="col-md-8">      <div class="card-body">        <h5 class="card-title">' + mods_author + ' (' + mods_year + '): <em>' + mods_title + '</em></h5><br>        <h6 class="card-subtitle mb-2 text-muted">Page Stats</h6>    <p class="font-monospace">    Total Pages: ' + str(int(pages_df_list_report_df.shape[0])) + '<br>    Total Words: ' + str(int(pages_df_list_report_df['count'].sum())) + '<br>    Total Lines: ' + str(int(pages_df_list_report_df['textlines'].sum())) + '<br>    </p>    <h6 class="card-subtitle mb-2 text-muted">Word Confidence</h6>    <p class="font-monospace">    &#8709;&nbsp;mean:&nbsp;' + str(pages_df_list_report_df['mean'].mean())[0:4] + '<br>\
-    &#8709;&nbsp;std:&nbsp;&nbsp;' + str(pages_df_list_report_df['std'].mean())[0:4] + '<br>\
+report_overview = '<div class="container"><h1><a href="https://resolver.sub.uni-hamburg.de/kitodo/' + record_id + '" class="link-dark">Result for ' + record_id + '</a></h1></div><div class="container"><div class="row gx-2 m-1"><div class="col-lg-12 col-md-12 h-100"><div class="card mb-3">  <div class="row g-0">    <div class="col-md-4">      <a href="https://mets.sub.uni-hamburg.de/kitodo/' + record_id + '"><img src="images/' + record_id + '.webp" class="img-fluid rounded-start" alt="..."></a>    </div>    <div class="col-md-8">      <div class="card-body">        <h5 class="card-title">' + mods_author + ' (' + mods_year + '): <em>' + mods_title + '</em></h5><br>        <h6 class="card-subtitle mb-2 text-muted">Page Stats</h6>    <p class="font-monospace">    Total Pages: ' + str(int(pages_df_list_report_df.shape[0])) + '<br>    Total Words: ' + str(int(pages_df_list_report_df['count'].sum())) + '<br>    Total Lines: ' + str(int(pages_df_list_report_df['textlines'].sum())) + '<br>    </p>    <h6 class="card-subtitle mb-2 text-muted">Word Confidence</h6>    <p class="font-monospace">    &#8709;&nbsp;mean:&nbsp;' + format(pages_df_list_report_df['mean'].mean(), '.2f') + '<br>\
+    &#8709;&nbsp;std:&nbsp;&nbsp;' + format(pages_df_list_report_df['std'].mean(), '.2f') + '<br>\
     <br>\
-    &#8709;&nbsp;25%:&nbsp;&nbsp;' + str(pages_df_list_report_df['25%'].mean())[0:4] + '<br>\
-    &#8709;&nbsp;50%:&nbsp;&nbsp;' + str(pages_df_list_report_df['50%'].mean())[0:4] + '<br>\
-    &#8709;&nbsp;75%:&nbsp;&nbsp;' + str(pages_df_list_report_df['75%'].mean())[0:4] + '<br>\
+    &#8709;&nbsp;25%:&nbsp;&nbsp;' + format(pages_df_list_report_df['25%'].mean(), '.2f') + '<br>\
+    &#8709;&nbsp;50%:&nbsp;&nbsp;' + format(pages_df_list_report_df['50%'].mean(), '.2f') + '<br>\
+    &#8709;&nbsp;75%:&nbsp;&nbsp;' + format(pages_df_list_report_df['75%'].mean(), '.2f') + '<br>\
     </p>\
         <img src="images/' + record_id + '_displot.png" class="img-fluid" alt="...">\
       </div>\
@@ -514,38 +656,56 @@ report_overview = '<div class="container"><h1><a href="https://resolver.sub.uni-
 </div>\
 '
 
+# collect the report as a list of fragments and join once at the end
+# (a repeated += would copy the whole report again for every single page)
+report_parts = [report_start, report_overview]
+
 # add container before first iteration
-report_details = '<div class="container">'
+report_parts.append('<div class="container">')
 
 # now fill it, but make sure, that each row has only 6 columns
 # Bootstrap has a gridsystem consisting of up to 12 columns each row, we go with 6
-for counter in range(len(fulltext_path)):
+# itertuples hands us each statistics row as a plain tuple, without any label lookups
+for counter, row in enumerate(pages_df_list_report_df.itertuples(index=False)):
+    wc_count, wc_mean, wc_std, wc_min, wc_q25, wc_q50, wc_q75, wc_max, wc_lines = row
 
     # close row after each 6 cards
     if counter % 6 == 0 and counter != 0:
-        report_details += '</div>'
+        report_parts.append('</div>')
     # add new row each 6 cards
     if counter % 6 == 0:
-        report_details += '<div class="row gx-2 m-1"></div><div class="row gx-2 m-1">'
-    
+        report_parts.append('<div class="row gx-2 m-1"></div><div class="row gx-2 m-1">')
+
     # add card to row
     # each card is a detailed statistic for each page with the heatmap of each page
-    report_details += '    <div class="col-lg-2 col-md-12 h-100">    <div class="card border-dark">    <a href="alto/' + str(counter + 1).zfill(8) + '.xml"><img src="images/' + str(counter) + '.png" class="card-img-top" alt="Page ' + str(counter + 1) + '"></a>    <div class="card-body">    <h5 class="card-title"><a href="https://pic.sub.uni-hamburg.de/kitodo/' + record_id + '/' + str(counter + 1).zfill(8) + '.tif" class="link-dark">Page ' + str(counter + 1) + '</a></h5>    <h6 class="card-subtitle mb-2 text-muted">Page Stats</h6>    <p class="font-monospace">    Words: ' + str(int(pages_df_list_report_df['count'].iloc[counter])) + '<br>    Lines: ' + str(len(pages_df_list[counter])) + '<br>    </p>    <h6 class="card-subtitle mb-2 text-muted">Word Confidence</h6>    <p class="font-monospace">    mean:&nbsp;' + str(pages_df_list_report_df['mean'].iloc[counter])[0:4] + '<br>    std:&nbsp;&nbsp;' + str(pages_df_list_report_df['std'].iloc[counter])[0:4] + '<br>    <br>    <!--min:&nbsp;&nbsp;' + str(pages_df_list_report_df['min'].iloc[counter])[0:4] + '<br>-->    25%:&nbsp;&nbsp;' + str(pages_df_list_report_df['25%'].iloc[counter])[0:4] + '<br>    50%:&nbsp;&nbsp;' + str(pages_df_list_report_df['50%'].iloc[counter])[0:4] + '<br>    75%:&nbsp;&nbsp;' + str(pages_df_list_report_df['75%'].iloc[counter])[0:4] + '<br>    <!--max:&nbsp;&nbsp;' + str(pages_df_list_report_df['max'].iloc[counter])[0:4] + '-->    </p>    </div>    </div>    </div>'
-    
+    report_parts.append(card_template.render(
+        record_id=record_id,
+        page=counter + 1,
+        image=str(counter) + '.webp',
+        alto=str(counter + 1).zfill(8) + '.xml',
+        tif=str(counter + 1).zfill(8) + '.tif',
+        words=int(wc_count),
+        lines=int(wc_lines),
+        mean=format(wc_mean, '.2f'),
+        std=format(wc_std, '.2f'),
+        min=format(wc_min, '.2f'),
+        q25=format(wc_q25, '.2f'),
+        q50=format(wc_q50, '.2f'),
+        q75=format(wc_q75, '.2f'),
+        max=format(wc_max, '.2f')))
+
 # close container if end of document
-report_details += '</div>'
+report_parts.append('</div>')
+report_parts.append(report_end)
 
 # now put all report-pieces together
-report = report_start + report_overview + report_details + report_end
-
-# cook a soup (we need an XML object from the string provided)
-report_soup = BeautifulSoup(report)
-# prettify the HTML, so it won't look nasty
-report_pretty = str(report_soup.prettify()).encode(encoding='UTF-8')
+report = ''.join(report_parts)
 
 # finally save our report
+# (no pretty printing - the browser does not care about indentation and
+# re-parsing the whole report just for whitespace is wasted time)
 with open(report_filename, 'wb') as report_file:
-    report_file.write(report_pretty)
+    report_file.write(report.encode('utf-8'))
 
 
 # # Done